@@ -1,5 +1,9 @@
 import os
-import time
+import functools
+import mmap
+import logging
+import signal
+import threading
 
 from gadgetsdk import GadgetInspectionSession
 
@@ -10,6 +14,24 @@ from gadgetsdk import GadgetInspectionSession
 # https://octoeverywhere.stoplight.io/docs/octoeverywhere-api-docs/3xadck728cc0t-octo-everywhere-ai-failure-detection-api
 #
 
+
+_log = logging.getLogger(__name__)
+
+# The paths to the sample images, resolved once at import.
+_SAMPLE_IMAGES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "sample-images")
+_GOOD_PRINT_PATH = os.path.join(_SAMPLE_IMAGES_DIR, "sample-good-print.jpg")
+_FAILED_PRINT_PATH = os.path.join(_SAMPLE_IMAGES_DIR, "sample-failed-print.jpg")
+
+
+@functools.lru_cache(maxsize=2)
+def _loadSampleImage(filePath:str) -> memoryview:
+    # A helper to map a sample image from disk into memory.
+    # The file is memory mapped read-only, so the image data is served from the OS page cache rather than copied into a new bytes object.
+    # The GadgetInspectionSession accepts any bytes-like object, so the memoryview can be returned directly from on_new_image_request.
+    with open(filePath, "rb") as f:
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
 class Example:
 
     # Using this example constant we can control how long after starting the session we start returning an image of a failed print.
@@ -19,10 +41,34 @@ class Example:
     # See the OctoEverywhere developer page or contact support to get your API key.
     ApiKey = ""
 
+    # The UI message for each print quality value, indexed by the print quality (1-10).
+    PrintQualityMessages = (
+        None,
+        "Your Print Has Failed!",
+        "There's Probably A Print Failure",
+        "There Might Be A Print Failure",
+        "Monitoring A Possible Print Issue",
+        "Monitoring A Possible Print Issue",
+        "Good Print Quality",
+        "Good Print Quality",
+        "Great Print Quality",
+        "Great Print Quality",
+        "Perfect Print Quality",
+    )
+
 
     def __init__(self):
-        self._startTimeSec = time.time()
         self.gadgetSession:GadgetInspectionSession = None
+        self._stopEvent = threading.Event()
+
+        # Load the sample images once, so we don't need to hit the disk every time an image is requested.
+        # The mapped images are shared by all Example instances in the process.
+        self._goodJpeg = _loadSampleImage(_GOOD_PRINT_PATH)
+        self._failedJpeg = _loadSampleImage(_FAILED_PRINT_PATH)
+
+        # The image returned for each snapshot request. This starts as the good print and is switched by a timer to the failed print.
+        self._currentImage = self._goodJpeg
+        self._failureTimer:threading.Timer = None
 
 
     def Run(self):
@@ -38,22 +84,32 @@ class Example:
         )
 
         # Start the session to run async.
+        # The session is backed by a single worker thread, which is where all of the callbacks below will be called from.
         self.gadgetSession.start()
 
+        # Start a one-shot timer that will switch the example over to returning the failed print image.
+        self._failureTimer = threading.Timer(Example.PrintFailureTimeStartSec, self._switchToFailedImage)
+        self._failureTimer.daemon = True
+        self._failureTimer.start()
+
         # Normally your program would return and do whatever else it wants to do, but in this case,
-        # we will just sleep to block the main thread.
-        time.sleep(50000)
+        # we will just block the main thread until Ctrl+C is pressed, and then stop the session.
+        # The wait is done in short slices, since on Windows an untimed wait can't be interrupted by Ctrl+C and the signal handler would never run.
+        signal.signal(signal.SIGINT, self._onStopSignal)
+        while not self._stopEvent.wait(1):
+            pass
+        self._failureTimer.cancel()
+        self.gadgetSession.stop()
 
 
-    def OnNewImageRequest(self) -> bytes:
+    def OnNewImageRequest(self) -> memoryview:
         # This function is called when a new webcam snapshot needs to be retrieved for processing.
         # The image type must be a jpeg image, and the bytes array should contain the image data including the jpeg image headers.
         # If the image can't be gotten or there's a failure, it should return None.
 
         # For this example, we will use two static images, one that's a good print and the other that's a failed print.
-        if time.time() - self._startTimeSec > self.PrintFailureTimeStartSec:
-            return self._getImage(False)
-        return self._getImage(True)
+        # The failure timer picks which one is returned, so there's no need to check the time on each request.
+        return self._currentImage
 
 
     def OnStateUpdate(self, printQuality:int, warningSuggested:bool, pauseSuggested:bool, score:int) -> None:
@@ -81,33 +137,22 @@ class Example:
         #                The score ranges from 0-100. 0 indicates a perfect print, and 100 indicates a strong probability of a failure.
         #                DO NOT USE this value for showing print quality or taking actions.
         #                This value can be used to programmatically interrupt the AI score for advanced processing such as smoothing, aggregation, or such.
-        print(f"Image processing complete. New State - Print Quality: {printQuality}, Warning: {warningSuggested}, Pause: {pauseSuggested}, Score: {score}")
+        # The messages use lazy logging formatting, so no strings are built if the INFO log level is disabled.
+        _log.info("Image processing complete. New State - Print Quality: %s, Warning: %s, Pause: %s, Score: %s", printQuality, warningSuggested, pauseSuggested, score)
 
         # Here's an example how how you might want to update your UI based on the print quality.
-        if printQuality == 1:
-            print("Your Print Has Failed!")
-        elif printQuality == 2:
-            print("There's Probably A Print Failure")
-        elif printQuality == 3:
-            print("There Might Be A Print Failure")
-        elif printQuality == 4 or printQuality == 5:
-            print("Monitoring A Possible Print Issue")
-        elif printQuality == 6 or printQuality == 7:
-            print("Good Print Quality")
-        elif printQuality == 8 or printQuality == 9:
-            print("Great Print Quality")
-        elif printQuality == 10:
-            print("Perfect Print Quality")
+        if 1 <= printQuality <= 10:
+            _log.info(Example.PrintQualityMessages[printQuality])
 
         # If a warning is suggested, you can inform the user on the UI or by sending them a message.
         if warningSuggested:
-            print("Hey! You're print might be failing. Go take a look!")
+            _log.info("Hey! You're print might be failing. Go take a look!")
 
         # If a pause is suggested you can pause the print.
         # If you do pause the print, you should call the pause method on the session, since there's no need to keep calling the API when the print is paused.
         # If the print is resumed, you can decided if you want to resume the session to continue monitoring or stop monitoring this print.
         if pauseSuggested:
-            print("Print pause suggested. Pausing the print...")
+            _log.info("Print pause suggested. Pausing the print...")
             self.gadgetSession.pause()
 
 
@@ -116,18 +161,21 @@ class Example:
         # errorType:str    - One of the well known errors as described in the API documentation.
         # errorDetails:str - A string with more information about the error.
         # Details: https://octoeverywhere.stoplight.io/docs/octoeverywhere-api-docs/3xadck728cc0t-ai-failure-detection-ap-is#errors
-        print(f"Error: {errorType} - {errorDetails}")
+        _log.error("Error: %s - %s", errorType, errorDetails)
+
+
+    def _onStopSignal(self, signum, frame) -> None:
+        # Called on Ctrl+C, this will unblock the main thread so the session can be stopped.
+        self._stopEvent.set()
 
 
-    def _getImage(self, goodPrint: bool) -> bytes:
-        # A helper function to get the image data from the sample images.
-        scriptFilePath = os.path.realpath(__file__)
-        scriptDir = os.path.dirname(scriptFilePath)
-        fileName = "sample-good-print.jpg" if goodPrint else "sample-failed-print.jpg"
-        with open(os.path.join(scriptDir, "sample-images", fileName), "rb") as f:
-            return f.read()
+    def _switchToFailedImage(self) -> None:
+        # Called by the failure timer once PrintFailureTimeStartSec has elapsed.
+        self._currentImage = self._failedJpeg
 
 
 if __name__ == "__main__":
+    # Log to the console, raise the level to WARNING to silence the per image state updates.
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     e = Example()
     e.Run()
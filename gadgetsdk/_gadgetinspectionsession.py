@@ -1,28 +1,96 @@
+import io
+import os
+import json
+import logging
+import hashlib
 import time
+import random
+import operator
+import asyncio
+import inspect
 import threading
-from typing import Callable
+from typing import Callable, Union
 
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ._multipartimagebody import MultipartImageBody
+
+_log = logging.getLogger(__name__)
+
+# Pillow is an optional dependency, it's only needed if the image downscaling option is used.
+try:
+    from PIL import Image # pylint: disable=import-error
+except ImportError:
+    Image = None
+
+# orjson is an optional dependency, if it's installed we use it for faster JSON parsing and encoding.
+try:
+    import orjson # pylint: disable=import-error
+    _jsonDumps = orjson.dumps # pylint: disable=no-member
+    def _jsonLoads(data):
+        # orjson is stricter than the stdlib parser, for example it rejects NaN, so if it fails we fall back to the stdlib.
+        try:
+            return orjson.loads(data) # pylint: disable=no-member
+        except orjson.JSONDecodeError: # pylint: disable=no-member
+            return json.loads(data)
+except ImportError:
+    _jsonLoads = json.loads
+    def _jsonDumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
 
 
 class GadgetInspectionSession:
 
+    # The worker thread reads many of these on every processing cycle, so we use slots for faster attribute access and a smaller instance.
+    # Any new instance attribute must be added here.
+    __slots__ = (
+        "apiKey", "on_new_image_request", "on_state_update", "on_error",
+        "minProcessingIntervalSec", "warningConfidenceLevel", "pauseConfidenceLevel",
+        "maxImageEdgePx", "jpegQuality", "skipDuplicateImages", "lastImageDigest",
+        "thread", "hasRan", "stopEvent", "resumeEvent",
+        "consecutiveFailures", "lastErrorHandlerLogSec",
+        "isAsyncImageRequest", "imageRequestLoop",
+        "httpSession", "CreateContextUrl",
+        "ContextId", "ProcessRequestUrl", "ProcessRequestFallbackUrl", "ActiveProcessRequestUrl",
+        "SleepIntervalSec",
+    )
+
     # Well known SDK Error Types
     # These Error Type or the Error Types defined in the API documentation can be fired by the SDK.
     ErrorTypeInternal = "OE_SDK_ERROR"
     ErrorTypeCallbackFailure = "OE_SDK_CALLBACK_EXCEPTION"
 
+    # The base URL of the Gadget API.
+    # This can be overridden with the OE_GADGET_BASE_URL environment variable, which is useful for local debugging or testing against a staging server.
+    BaseUrl = os.environ.get("OE_GADGET_BASE_URL", "https://gadget-pv1-oeapi.octoeverywhere.com").rstrip("/")
+
+    # The per request headers for JSON bodies. The API key header is set once on the HTTP session, so it's not needed here.
+    JsonContentTypeHeaders = {"Content-Type": "application/json"}
+
+    # The required values in a process API response, and a getter for all of them in a single call.
+    # The getter raises a KeyError with the field name if one is missing.
+    ProcessResponseFieldNames = ("NextProcessIntervalSec", "PrintQuality", "WarningSuggested", "PauseSuggested", "Score")
+    ProcessResponseFields = operator.itemgetter(*ProcessResponseFieldNames)
+
+    # The max time we will sleep between API calls after consecutive failures.
+    FailureBackoffMaxSec = 5 * 60
+
 
     def __init__(
         self,
         apiKey: str,
         minProcessingIntervalSec:int = 0,
-        on_new_image_request:  Callable[[None], bytes] = None,
+        on_new_image_request:  Callable[[None], Union[bytes, bytearray, memoryview]] = None,
         on_state_update:       Callable[[int, bool, bool, int], None] = None,
         on_error:              Callable[[str, str], None] = None,
         warningConfidenceLevel:int = None,
         pauseConfidenceLevel:  int = None,
+        maxImageEdgePx:        int = None,
+        jpegQuality:           int = 80,
+        skipDuplicateImages:   bool = False,
     ) -> None:
         """
         GadgetInspectionSession Initialization
@@ -37,8 +105,12 @@ class GadgetInspectionSession:
             If the value is 0 (default), we will call the API at the dynamic interval requested by the API after each request.
             If the value is set to a positive number, we will use which ever is larger, the dynamic interval from the API or the value set here.
 
-        on_new_image_request: function () -> bytes
-            Callback for when a new image needs to be processed for print failure detection. This function should return the image data or None if no image is available.
+        on_new_image_request: function () -> bytes | bytearray | memoryview
+            Callback for when a new image needs to be processed for print failure detection. This function should return the image data as bytes or any bytes-like object (like a bytearray or memoryview), or None if no image is available.
+            The image data is uploaded directly from the returned buffer without being copied, and the buffer isn't used after the upload completes.
+            So it's safe to reuse a single bytearray for every image, which avoids allocating a new buffer each time.
+            This can also be an async function, in which case it will be awaited on an event loop owned by the session's worker thread.
+            This allows the image to be fetched with async libraries, like aiohttp.
 
         on_state_update: function(score:int, warningSuggested:bool, pauseSuggested:bool) -> None
             Callback after an image process when there's a new model state.
@@ -84,6 +156,19 @@ class GadgetInspectionSession:
             The value must be between 1-5, where 1 is the least confident (will pause with less confidence) and 5 is the most confident (will only pause when very confident).
             If not set, the default value of 3 will be used.
             Full details: https://octoeverywhere.stoplight.io/docs/octoeverywhere-api-docs/kgomtjwkt3dj9-create-context
+
+        maxImageEdgePx: int = None
+            If set, images with a width or height larger than this value will be scaled down and re-encoded as a jpeg before they are uploaded.
+            This reduces the upload size, which is useful on slow or metered connections. Requires the Pillow package to be installed.
+            If not set (default), images are uploaded as they are returned from on_new_image_request.
+
+        jpegQuality: int = 80
+            The jpeg quality, between 1-95, used when an image is re-encoded due to maxImageEdgePx.
+
+        skipDuplicateImages: bool = False
+            If set, an image that's byte for byte identical to the last successfully processed image isn't uploaded, and that processing cycle is skipped.
+            This saves bandwidth when the webcam image doesn't change, like when the printer is idle.
+            Note the temporal combination model builds confidence over many images, so skipped images don't count towards warning or pause suggestions.
         """
         self.apiKey = apiKey
         self.on_new_image_request = on_new_image_request
@@ -92,12 +177,23 @@ class GadgetInspectionSession:
         self.minProcessingIntervalSec = minProcessingIntervalSec
         self.warningConfidenceLevel = warningConfidenceLevel
         self.pauseConfidenceLevel = pauseConfidenceLevel
+        self.maxImageEdgePx = maxImageEdgePx
+        self.jpegQuality = jpegQuality
+        self.skipDuplicateImages = skipDuplicateImages
+        # If skipDuplicateImages is set, this is the hash of the last successfully processed image.
+        self.lastImageDigest:bytes = None
         self.thread:threading.Thread = None
-        self.threadLock = threading.Lock()
         self.hasRan = False
-        self.isRunning = False
-        self.isPaused = False
-        self.UseFallbackUrl = False
+        # This event is set when the session is stopped, the worker thread sleeps on it so it wakes up right away on stop.
+        self.stopEvent = threading.Event()
+        # This event is set when the session isn't paused, the worker thread waits on it while paused.
+        self.resumeEvent = threading.Event()
+        self.resumeEvent.set()
+        self.consecutiveFailures = 0
+        self.lastErrorHandlerLogSec = 0.0
+        # If the image request callback is async, this is the event loop used to run it. It's created and closed by the worker thread.
+        self.isAsyncImageRequest = inspect.iscoroutinefunction(on_new_image_request)
+        self.imageRequestLoop:asyncio.AbstractEventLoop = None
 
         # Ensure the required values are set.
         if self.apiKey is None or len(self.apiKey) == 0:
@@ -112,6 +208,40 @@ class GadgetInspectionSession:
             raise Exception("warningConfidenceLevel must be between 1 and 5.")
         if self.pauseConfidenceLevel is not None and (self.pauseConfidenceLevel < 1 or self.pauseConfidenceLevel > 5):
             raise Exception("pauseConfidenceLevel must be between 1 and 5.")
+        if self.maxImageEdgePx is not None:
+            if self.maxImageEdgePx < 1:
+                raise Exception("maxImageEdgePx must be a positive number.")
+            if Image is None:
+                raise Exception("The Pillow package must be installed to use maxImageEdgePx.")
+        if self.jpegQuality < 1 or self.jpegQuality > 95:
+            raise Exception("jpegQuality must be between 1 and 95.")
+
+        # We use one HTTP session for all of the API calls, so the connection is kept alive and reused between requests.
+        # The API key is set as a default header, so it's sent with every request.
+        self.httpSession = requests.Session()
+        self.httpSession.headers.update({"X-API-Key": self.apiKey})
+        # Connection failures and service unavailable errors are retried with a short backoff inside of a single API call.
+        # Read errors and gateway errors aren't retried, since the server might have already received the image and still be processing it.
+        # Re-sending an image the server already processed would count it twice in the temporal model.
+        # The Retry-After header isn't honored, since the retry sleep can't be interrupted by stop() and the server could ask for a very long wait.
+        # If the retries fail, the normal error handling takes over, including switching to the fallback URL.
+        retry = Retry(
+            total=3,
+            read=0,
+            backoff_factor=0.5,
+            status_forcelist=(503,),
+            allowed_methods=frozenset(["POST"]),
+            respect_retry_after_header=False,
+            raise_on_status=False
+        )
+        # The session talks to at most three hosts, the create context host and the main and fallback process hosts.
+        # Only one request is made at a time, so each host only needs one kept alive connection.
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=3, pool_maxsize=1)
+        self.httpSession.mount("https://", adapter)
+        self.httpSession.mount("http://", adapter)
+
+        # The create context URL is the same for every attempt, so it's built once.
+        self.CreateContextUrl = GadgetInspectionSession.BaseUrl + "/api/gadget/v1/createcontext"
 
         # Session Context Information
         # This is the ID of this context we use to identify the session.
@@ -120,6 +250,9 @@ class GadgetInspectionSession:
         self.ProcessRequestUrl:str = None
         # This is returned when we create the context, it's the URL we should try as a fallback if our main processing requests URL fails.
         self.ProcessRequestFallbackUrl:str = None
+        # This is the process URL we are currently using. It starts as the main URL and is switched to the fallback URL if the main URL fails.
+        # Note once we switch to the fallback URL, we will use it for the rest of the session.
+        self.ActiveProcessRequestUrl:str = None
 
         # This is the min amount of time we must sleep as requested from the process API
         # This value can be updated by the Process API on each response, but we clamp it by minProcessingIntervalSec.
@@ -131,14 +264,13 @@ class GadgetInspectionSession:
         """
         Starts the inspection session on an async thread.
         After this is called, a context will be created and the call backs will start firing.
+        Each session uses one long lived worker thread for its lifetime, all of the callbacks are fired from that thread.
         """
-        with self.threadLock:
-            if self.hasRan is True:
-                raise Exception("The Gadget session has already been started, each session can only be used once.")
-            self.hasRan = True
-            self.isRunning = True
-            self.thread = threading.Thread(target=self._threadWorker)
-            self.thread.start()
+        if self.hasRan is True:
+            raise Exception("The Gadget session has already been started, each session can only be used once.")
+        self.hasRan = True
+        self.thread = threading.Thread(target=self._threadWorker, name="GadgetInspectionSession")
+        self.thread.start()
 
 
     def pause(self) -> None:
@@ -146,58 +278,122 @@ class GadgetInspectionSession:
         Pauses the session from processing new images, and thus pauses the API calls.
         This is useful for temporally stopping the session without stopping it, like if a failure is detected.
         """
-        with self.threadLock:
-            self.isPaused = True
+        self.resumeEvent.clear()
 
 
     def resume(self) -> None:
         """
         Resumes the session. The session will start processing new images again and start firing the callbacks for data.
         """
-        with self.threadLock:
-            self.isPaused = False
+        self.resumeEvent.set()
 
 
     def stop(self) -> None:
         """
         Stop the inspection session. Once the session is stopped, it can't be started again, a new session must be created.
         """
-        with self.threadLock:
-            if self.thread is not None:
-                self.isRunning = False
-                self.thread.join()
-                self.thread = None
+        # The events are thread safe, so no lock is needed. This also makes it safe to call stop from one of the callbacks.
+        self.stopEvent.set()
+        # Wake the worker if it's paused, so it can see the session has stopped.
+        self.resumeEvent.set()
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        # The session can't be started again, so close any open connections.
+        self.httpSession.close()
+
+
+    @property
+    def isRunning(self) -> bool:
+        """
+        True if the session has been started and hasn't been stopped.
+        """
+        return self.hasRan and not self.stopEvent.is_set()
+
+
+    @property
+    def isPaused(self) -> bool:
+        """
+        True if the session is paused.
+        """
+        return not self.resumeEvent.is_set()
+
+
+    @property
+    def UseFallbackUrl(self) -> bool:
+        """
+        True if the session has switched to the fallback process URL.
+        """
+        return self.ActiveProcessRequestUrl is not None and self.ActiveProcessRequestUrl is self.ProcessRequestFallbackUrl
 
 
     def _threadWorker(self) -> None:
+        # If the image request callback is async, create an event loop for this thread to run it on.
+        if self.isAsyncImageRequest:
+            self.imageRequestLoop = asyncio.new_event_loop()
+        try:
+            self._threadLoop()
+        finally:
+            if self.imageRequestLoop is not None:
+                self.imageRequestLoop.close()
+                self.imageRequestLoop = None
+
+
+    def _threadLoop(self) -> None:
         # Once we are running, we will keep running until the session is stopped.
-        while self.isRunning:
+        while not self.stopEvent.is_set():
+            # If we are paused, block until the session is resumed or stopped, rather than waking up to check.
+            if not self.resumeEvent.is_set():
+                self.resumeEvent.wait()
+                continue
+
+            # By default, we sleep the requested interval at the end of each loop.
+            sleepSec = self.SleepIntervalSec
             try:
-                # If we are paused, we will skip processing, we will just sleep the last requested time interval and check again.
-                if self.isPaused is False:
-
-                    # Ensure we have a context.
-                    if not self._ensureSessionContext():
-                        # If we failed to create a context, we will sleep for a bit and try again.
-                        time.sleep(30)
-                        continue
-
-                    # If we have a context, we can now process a new image.
-                    imageBytes = None
-                    try:
-                        imageBytes = self.on_new_image_request()
-                    except Exception as e:
-                        self._fireOnError(GadgetInspectionSession.ErrorTypeCallbackFailure, str(e))
-
-                    # If the client returns none we skip this processing.
-                    if imageBytes is not None:
-                        self._processImage(imageBytes)
+                # Ensure we have a context.
+                if not self._ensureSessionContext():
+                    # If we failed to create a context, we will back off and try again.
+                    # The backoff starts short, so we recover quickly from a brief network issue, and grows if the failures continue.
+                    self.consecutiveFailures += 1
+                    if self.stopEvent.wait(self._getFailureBackoffSec(0)):
+                        break
+                    continue
+
+                # If we have a context, we can now process a new image.
+                cycleStartSec = time.monotonic()
+                imageBytes = None
+                try:
+                    imageBytes = self._requestNewImage()
+                except Exception as e:
+                    self._fireOnError(GadgetInspectionSession.ErrorTypeCallbackFailure, str(e))
+
+                # If the client returns none we skip this processing.
+                if imageBytes is not None:
+                    if self._processImage(imageBytes):
+                        self.consecutiveFailures = 0
+                        # The interval is the time between the start of each processing cycle, so the time spent getting the image and calling the API is taken out of the sleep.
+                        sleepSec = max(0, self.SleepIntervalSec - (time.monotonic() - cycleStartSec))
+                    else:
+                        # On failure, back off, but never call the API faster than the requested interval.
+                        self.consecutiveFailures += 1
+                        sleepSec = self._getFailureBackoffSec(self.SleepIntervalSec)
 
             except Exception as e:
+                self.consecutiveFailures += 1
+                sleepSec = self._getFailureBackoffSec(self.SleepIntervalSec)
                 self._fireOnError(GadgetInspectionSession.ErrorTypeInternal, str(e))
 
-            # At the end of each loop, regardless of state, always sleep the requested interval.
-            time.sleep(self.SleepIntervalSec)
+            # At the end of each loop, regardless of state, always sleep.
+            # The sleep is done on the stop event, so stop() doesn't need to wait for the sleep to finish.
+            if self.stopEvent.wait(sleepSec):
+                break
+
+
+    # Calls the image request callback, awaiting it if it's async.
+    def _requestNewImage(self):
+        if self.imageRequestLoop is not None:
+            return self.imageRequestLoop.run_until_complete(self.on_new_image_request())
+        return self.on_new_image_request()
 
 
     # Ensures there's a session context, if not, one is created.
@@ -210,42 +406,40 @@ class GadgetInspectionSession:
         try:
             # If there's no context, create one now.
             # These value are optional, if they aren't used, the service will use the default value of 3.
-            json = {
+            requestJson = {
                 "WarningConfidenceLevel": self.warningConfidenceLevel,
                 "PauseConfidenceLevel": self.pauseConfidenceLevel
             }
-            response = requests.post(
-                self._buildUrl("/api/gadget/v1/createcontext"),
-                json=json,
-                headers={
-                    "X-API-Key": self.apiKey
-                },
+            response = self.httpSession.post(
+                self.CreateContextUrl,
+                data=_jsonDumps(requestJson),
+                headers=GadgetInspectionSession.JsonContentTypeHeaders,
                 timeout = 30
             )
 
-            # Check for a valid response.
-            if response.status_code != 200:
-                # If the API failed, see if we can parse the error.
-                errorType, errorDetails = self._tryParseApiErrorResponse(response)
-                if errorType is not None and errorDetails is not None:
-                    self._fireOnError(errorType, errorDetails)
-                    return False
-                raise Exception(f"Failed to create a new session context. Status: {response.status_code}, Body: " + response.text)
+            # Check for a valid response and parse it.
+            responseJson = self._checkResponse(response, "Failed to create a new session context.")
+            if responseJson is None:
+                return False
 
-            # Parse the response.
             # Grab the data we need.
-            responseJson = response.json()
-            self.ContextId = responseJson.get("ContextId", None)
-            self.ProcessRequestUrl = responseJson.get("ProcessRequestUrl", None)
-            self.ProcessRequestFallbackUrl = responseJson.get("FallbackProcessRequestUrl", None)
-
-            # Validate the data we got.
-            if self.ContextId is None:
-                raise Exception("Failed to get a valid context ID from the response.")
-            if self.ProcessRequestUrl is None:
+            # All of the values are required, so we only set them once we know they are all there.
+            try:
+                contextId = responseJson["ContextId"]
+                processRequestUrl = responseJson["ProcessRequestUrl"]
+                processRequestFallbackUrl = responseJson["FallbackProcessRequestUrl"]
+            except KeyError as e:
+                raise Exception(f"Failed to get a valid {e.args[0]} from the response.") from e
+            if contextId is None:
+                raise Exception("Failed to get a valid ContextId from the response.")
+            if processRequestUrl is None:
                 raise Exception("Failed to get a valid ProcessRequestUrl from the response.")
-            if self.ProcessRequestFallbackUrl is None:
+            if processRequestFallbackUrl is None:
                 raise Exception("Failed to get a valid FallbackProcessRequestUrl from the response.")
+            self.ProcessRequestUrl = processRequestUrl
+            self.ProcessRequestFallbackUrl = processRequestFallbackUrl
+            self.ActiveProcessRequestUrl = processRequestUrl
+            self.ContextId = contextId
 
             # Context created!
             return True
@@ -256,72 +450,105 @@ class GadgetInspectionSession:
 
 
     # Calls the image process API and handles firing the resulting callbacks.
-    def _processImage(self, imageBytes) -> None:
+    # Returns True if the API call was successful, False on failure and will call the error handler.
+    def _processImage(self, imageBytes) -> bool:
         try:
-            # Use the main process request URl unless it has failed and we are using the fallback.
-            # Note once we switch to the fallback URL, we will use it for the rest of the session.
-            requestUrl = self.ProcessRequestUrl if not self.UseFallbackUrl else self.ProcessRequestFallbackUrl
-
-            # Create the image payload request, the image must be sent as a multipart form file attachment, called "snapshot".
-            files = {}
-            files['attachment'] = ("snapshot", imageBytes)
-
-            # Make the image process request.
-            # We use a long timeout to allow the server a good amount of time for the processing.
-            response = requests.post(
-                requestUrl,
-                files=files,
-                headers={
-                    "X-API-Key": self.apiKey
-                },
-                timeout = 2 * 60
-            )
-
-            # Check for a valid response.
-            if response.status_code != 200:
-                # If the API failed, see if we can parse the error.
-                errorType, errorDetails = self._tryParseApiErrorResponse(response)
-                if errorType is not None and errorDetails is not None:
-                    # If we fail for any reason, switch to the fallback URL.
-                    self.UseFallbackUrl = True
-                    self._fireOnError(errorType, errorDetails)
-                    return
-                raise Exception(f"Failed to call Process API. Status: {response.status_code}, Body: " + response.text)
+            # If enabled, skip the image if it's the same as the last image we processed.
+            # BLAKE2b is much faster than the upload, so the hash cost is negligible.
+            imageDigest = None
+            if self.skipDuplicateImages:
+                imageDigest = hashlib.blake2b(imageBytes, digest_size=16).digest()
+                if imageDigest == self.lastImageDigest:
+                    return True
+            if self.maxImageEdgePx is not None:
+                imageBytes = self._downscaleImage(imageBytes)
+            response = self._postImage(imageBytes)
+            success = self._handleProcessResponse(response)
+            # Only remember the image if it was processed, so failed images are always sent again.
+            self.lastImageDigest = imageDigest if success else None
+            return success
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            # If we still can't reach the server after the HTTP adapter's retries, switch to the fallback URL.
+            self.ActiveProcessRequestUrl = self.ProcessRequestFallbackUrl
+            self.lastImageDigest = None
+            self._fireOnError(GadgetInspectionSession.ErrorTypeInternal, str(e))
+        except Exception as e:
+            self.lastImageDigest = None
+            self._fireOnError(GadgetInspectionSession.ErrorTypeInternal, str(e))
+        return False
 
-            # Parse the response.
-            # Grab the data we need.
-            responseJson = response.json()
-            nextProcessIntervalSec = responseJson.get("NextProcessIntervalSec", None)
-            printQuality = responseJson.get("PrintQuality", None)
-            warningSuggested = responseJson.get("WarningSuggested", None)
-            pauseSuggested = responseJson.get("PauseSuggested", None)
-            score = responseJson.get("Score", None)
-
-            # Set the next processing interval.
-            if nextProcessIntervalSec is None:
-                raise Exception("Failed to get a valid NextProcessIntervalSec from process API response.")
-            self._sanityCheckAndSetProcessingInterval(nextProcessIntervalSec)
-
-            # Validate the results
-            if score is None:
-                raise Exception("Failed to get a valid Score from process API response.")
-            if printQuality is None:
-                raise Exception("Failed to get a valid PrintQuality from process API response.")
-            if warningSuggested is None:
-                raise Exception("Failed to get a valid WarningSuggested from process API response.")
-            if pauseSuggested is None:
-                raise Exception("Failed to get a valid PauseSuggested from process API response.")
-
-            # Fire the state update callback.
-            try:
-                self.on_state_update(printQuality, warningSuggested, pauseSuggested, score)
-            except Exception as e:
-                self._fireOnError(GadgetInspectionSession.ErrorTypeCallbackFailure, str(e))
 
+    # Makes the image process request and returns the response. This only does the network I/O, the response is handled by _handleProcessResponse.
+    def _postImage(self, imageBytes) -> requests.Response:
+        # Use the main process request URl unless it has failed and we are using the fallback.
+        requestUrl = self.ActiveProcessRequestUrl
+
+        # Create the image payload request, the image must be sent as a multipart form file attachment, called "snapshot".
+        # The body streams the image from the buffer we were given, rather than copying it into a new multipart body.
+        body = MultipartImageBody("attachment", "snapshot", imageBytes)
+
+        # Make the image process request.
+        # We use a long timeout to allow the server a good amount of time for the processing.
+        return self.httpSession.post(
+            requestUrl,
+            data=body,
+            headers={
+                "Content-Type": body.ContentType
+            },
+            timeout = 2 * 60
+        )
+
+
+    # Parses the image process response and fires the resulting callbacks.
+    # Returns True if the API call was successful, False if the API returned an error and will call the error handler. Throws on an invalid response.
+    def _handleProcessResponse(self, response:requests.Response) -> bool:
+        # If the server failed, even after the HTTP adapter's retries, switch to the fallback URL.
+        # Client errors, like an invalid API key, would fail the same way on the fallback, so we don't switch for them.
+        if response.status_code >= 500:
+            self.ActiveProcessRequestUrl = self.ProcessRequestFallbackUrl
+
+        # Check for a valid response and parse it.
+        responseJson = self._checkResponse(response, "Failed to call Process API.")
+        if responseJson is None:
+            return False
+
+        # Grab the data we need.
+        # All of the values are required, if any are missing the response is invalid.
+        try:
+            fields = GadgetInspectionSession.ProcessResponseFields(responseJson)
+        except KeyError as e:
+            raise Exception(f"Failed to get a valid {e.args[0]} from process API response.") from e
+        if None in fields:
+            fieldName = GadgetInspectionSession.ProcessResponseFieldNames[fields.index(None)]
+            raise Exception(f"Failed to get a valid {fieldName} from process API response.")
+        nextProcessIntervalSec, printQuality, warningSuggested, pauseSuggested, score = fields
+
+        # Set the next processing interval.
+        self._sanityCheckAndSetProcessingInterval(nextProcessIntervalSec)
+
+        # Fire the state update callback.
+        try:
+            self.on_state_update(printQuality, warningSuggested, pauseSuggested, score)
         except Exception as e:
-            # If we fail for any reason, switch to the fallback URL.
-            self.UseFallbackUrl = True
-            self._fireOnError(GadgetInspectionSession.ErrorTypeInternal, str(e))
+            self._fireOnError(GadgetInspectionSession.ErrorTypeCallbackFailure, str(e))
+        return True
+
+
+    def _downscaleImage(self, imageBytes):
+        # A helper to scale the image down to fit within maxImageEdgePx and re-encode it as a jpeg.
+        # If the image already fits, the original image is returned as-is, so it's not re-encoded.
+        with Image.open(io.BytesIO(imageBytes)) as img:
+            maxSize = (self.maxImageEdgePx, self.maxImageEdgePx)
+            if img.width <= self.maxImageEdgePx and img.height <= self.maxImageEdgePx:
+                return imageBytes
+            # For jpegs, draft lets the decoder scale the image down while decoding, which is much faster than decoding the full image.
+            img.draft("RGB", maxSize)
+            img.thumbnail(maxSize)
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            buffer = io.BytesIO()
+            img.save(buffer, "JPEG", quality=self.jpegQuality)
+            return buffer.getbuffer()
 
 
     def _sanityCheckAndSetProcessingInterval(self, newValueSec:int) -> None:
@@ -335,25 +562,45 @@ class GadgetInspectionSession:
         self.SleepIntervalSec = newValueSec
 
 
-    def _buildUrl(self, suffix) -> str:
-        # A helper function to help local debugging.
-        localServerDebugAddress = None
-        if localServerDebugAddress is not None:
-            return "http://" + localServerDebugAddress + suffix
-        return "https://gadget-pv1-oeapi.octoeverywhere.com" + suffix
+    def _getFailureBackoffSec(self, minSleepSec:float) -> float:
+        # A helper to get how long to sleep after consecutive API failures.
+        # The backoff starts at 1 second and doubles with each consecutive failure, and it's capped so we don't hammer the API during an outage.
+        # The jitter keeps many clients that failed at the same time from all retrying at the same time.
+        # The jitter is applied before the min sleep is enforced, so we never sleep less than minSleepSec.
+        backoffSec = min(GadgetInspectionSession.FailureBackoffMaxSec, 2 ** min(max(self.consecutiveFailures - 1, 0), 9))
+        return max(minSleepSec, backoffSec * random.uniform(0.8, 1.2))
+
+
+    def _checkResponse(self, response: requests.Response, failureMessage:str):
+        # Checks an API response and returns the parsed JSON body if it was successful.
+        # If the API returned a well-known error, it's sent to the error handler and None is returned. Any other failure throws.
+        if response.status_code == 200:
+            return _jsonLoads(response.content)
+        errorType, errorDetails, bodyText = self._tryParseApiErrorResponse(response)
+        if errorType is not None and errorDetails is not None:
+            self._fireOnError(errorType, errorDetails)
+            return None
+        raise Exception(f"{failureMessage} Status: {response.status_code}, Body: " + bodyText)
 
 
     def _tryParseApiErrorResponse(self, response: requests.Response):
         # Given a http response, this will try to parse the wellknown error type out if possible.
-        try:
-            json = response.json()
-            errorType = json.get("ErrorType", None)
-            errorDetails = json.get("ErrorDetails", None)
-            if errorType is not None and errorDetails is not None:
-                return (errorType, errorDetails)
-        except Exception:
-            pass
-        return (None, None)
+        # Returns (errorType, errorDetails, bodyText), the error values are None if they can't be parsed, and the body text is only set if they can't be.
+        # If the server says the body isn't JSON, like an HTML error page from a proxy, we don't try to parse it.
+        # The body is read once and used for both the JSON parsing and the error text.
+        body = response.content
+        contentType = response.headers.get("Content-Type", None)
+        if contentType is None or "json" in contentType:
+            try:
+                responseJson = _jsonLoads(body)
+                errorType = responseJson.get("ErrorType", None)
+                errorDetails = responseJson.get("ErrorDetails", None)
+                if errorType is not None and errorDetails is not None:
+                    return (errorType, errorDetails, None)
+            except Exception:
+                pass
+        # The body text is only used for error messages, so it's capped to 4KB in case the server returned a large error page.
+        return (None, None, body[:4096].decode("utf-8", errors="replace"))
 
 
     def _fireOnError(self, errorType:str, errorDetails: str) -> None:
@@ -361,5 +608,9 @@ class GadgetInspectionSession:
         if self.on_error is not None:
             try:
                 self.on_error(errorType, errorDetails)
-            except Exception as e:
-                print(f"Error in error handler: {str(e)}")
+            except Exception:
+                # If the error handler itself is failing, log it, but at most once per second so a broken handler can't flood the log.
+                nowSec = time.monotonic()
+                if nowSec - self.lastErrorHandlerLogSec >= 1.0:
+                    self.lastErrorHandlerLogSec = nowSec
+                    _log.exception("Error in error handler")
@@ -0,0 +1,58 @@
+import uuid
+
+
+# A multipart/form-data request body with a single file attachment.
+#
+# requests builds multipart bodies by copying the file data into a new buffer. This class instead exposes the body as a
+# readable stream that reads the image directly from the caller's buffer, so the image is never copied as a whole.
+# It's seekable so the body can be rewound if the HTTP adapter retries the request.
+class MultipartImageBody:
+
+    def __init__(self, fieldName:str, fileName:str, imageBytes) -> None:
+        boundary = uuid.uuid4().hex
+        self.ContentType = "multipart/form-data; boundary=" + boundary
+        head = f'--{boundary}\r\nContent-Disposition: form-data; name="{fieldName}"; filename="{fileName}"\r\n\r\n'.encode("utf-8")
+        tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+        # The body is the concatenation of these parts, the image is held as a flat byte view over the caller's buffer.
+        self.parts = (memoryview(head), memoryview(imageBytes).cast("B"), memoryview(tail))
+        self.length = sum(len(p) for p in self.parts)
+        self.position = 0
+
+
+    def __len__(self) -> int:
+        # Used by requests to set the Content-Length header.
+        return self.length
+
+
+    def tell(self) -> int:
+        return self.position
+
+
+    def seek(self, offset:int, whence:int = 0) -> int:
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.length
+        self.position = max(0, min(offset, self.length))
+        return self.position
+
+
+    def read(self, size:int = -1):
+        # Reads up to size bytes from the current position. This returns at most one part per call, which is fine for stream readers since they read until an empty result.
+        # If size is negative, the rest of the body is returned.
+        if size is None or size < 0:
+            return b"".join(bytes(self._readPart(self.length)) for _ in self.parts)
+        return self._readPart(size)
+
+
+    def _readPart(self, size:int):
+        partStart = 0
+        for part in self.parts:
+            partEnd = partStart + len(part)
+            if self.position < partEnd:
+                offset = self.position - partStart
+                data = part[offset:offset + size]
+                self.position += len(data)
+                return data
+            partStart = partEnd
+        return b""